@@ -211,7 +211,10 @@ class DownloaderViewModel(application: Application) : AndroidViewModel(applicati
                         null // Progress callback (simplified for now)
                     ).toString()
 
-                    JSONObject(resultJson)
+                    JSONObject(resultJson).apply {
+                        // Per-platform failure counters and circuit breaker state
+                        put("retry_stats", module.callAttr("get_retry_stats").toString())
+                    }
                 }
 
                 // Parse logs from Python
@@ -267,8 +270,13 @@ class DownloaderViewModel(application: Application) : AndroidViewModel(applicati
                     // Stop foreground service
                     DownloadService.stop(getApplication())
                 } else {
-                    val errorMsg = result.optString("error", "Download failed")
+                    val retryAfter = result.optInt("retry_after", 0)
+                    val errorMsg = result.optString("error", "Download failed").let {
+                        if (retryAfter > 0) "$it (try again in ${retryAfter}s)" else it
+                    }
                     addLog("Download failed: $errorMsg", "ERROR")
+                    addLog("Error kind: ${result.optString("error_kind", "unknown")}", "ERROR")
+                    addLog("Retry stats: ${result.optString("retry_stats")}", "INFO")
 
                     if (result.has("traceback")) {
                         addLog("Traceback: ${result.getString("traceback")}", "ERROR")
@@ -4,11 +4,46 @@ Video Downloader - yt-dlp wrapper for Android
 
 import os
 import json
+import time
+import random
 import traceback
 import shutil
+import threading
 from datetime import datetime
 import yt_dlp
 
+# Storage admission
+MIN_FREE_BYTES = 200 * 1024 * 1024  # Always leave this much free on the device
+MAX_WRITERS_PER_DEVICE = 1  # SD cards and slow flash thrash with parallel writers
+
+_writer_slots = {}
+_writer_slots_lock = threading.Lock()
+
+
+class DownloadAborted(Exception):
+    """A download was refused for lack of space or ended without writing its file"""
+
+
+def expected_size(info):
+    """Bytes the selected format(s) will take, from extraction's size fields; 0 if unknown"""
+    duration = info.get('duration') or 0
+    total = 0
+    for fmt in info.get('requested_formats') or [info]:
+        size = fmt.get('filesize') or fmt.get('filesize_approx')
+        if not size and fmt.get('tbr') and duration:
+            size = fmt['tbr'] * 125 * duration  # kbit/s -> bytes
+        total += int(size or 0)
+    return total
+
+
+def writer_slot(path):
+    """Semaphore limiting concurrent downloads onto the device holding path"""
+    device = os.stat(path).st_dev
+    with _writer_slots_lock:
+        if device not in _writer_slots:
+            _writer_slots[device] = threading.BoundedSemaphore(MAX_WRITERS_PER_DEVICE)
+        return _writer_slots[device]
+
 
 class Logger:
     """Collects log messages with timestamps"""
@@ -121,6 +156,152 @@ def detect_platform(url):
         return 'unknown'
 
 
+# Retry policy
+PERMANENT = 'permanent'  # Won't succeed with any format, stop
+TRANSIENT = 'transient'  # Device-side network hiccup, retry the same format with backoff
+SERVER_ERROR = 'server_error'  # Site returned 5xx, retry with backoff and count toward the breaker
+RATE_LIMITED = 'rate_limited'  # Site is throttling us, stop and open the breaker
+FALLBACK = 'fallback'  # Format, local or unknown failure, try the next format once
+
+MAX_TRANSIENT_RETRIES = 3  # Per format, before moving on to the next fallback
+BACKOFF_BASE = 1.0  # Seconds
+BACKOFF_CAP = 30.0
+BREAKER_THRESHOLD = 3  # Consecutive site 5xx failures that open the breaker
+BREAKER_COOLDOWN = 60.0  # Seconds, doubled each time the breaker re-opens
+BREAKER_MAX_COOLDOWN = 15 * 60.0
+BREAKER_MAX_WAIT = 120.0  # Longest a download will wait for a breaker before failing
+
+# Checked in order; format errors first since they also say "not available".
+# Anything unmatched is FALLBACK so unknown errors never trigger retries.
+ERROR_PATTERNS = [
+    (FALLBACK, ['requested format', 'format is not available', 'no video formats',
+                'ffmpeg', 'postprocessing', 'no space left']),
+    (RATE_LIMITED, ['http error 429', 'too many requests', 'rate limit', 'rate-limit',
+                    "confirm you're not a bot", 'please wait a few minutes']),
+    (PERMANENT, ['private video', 'video is private', 'video unavailable', 'video is unavailable',
+                 'video is not available', 'has been removed', 'not available in your country',
+                 'geo restrict', 'geo-restrict', 'login required', 'sign in to confirm your age',
+                 'members-only', 'copyright', 'unsupported url', 'does not exist',
+                 'http error 404', 'http error 410']),
+    (SERVER_ERROR, ['http error 500', 'http error 502', 'http error 503', 'http error 504']),
+    (TRANSIENT, ['timed out', 'connection reset', 'connection refused', 'connection aborted',
+                 'remote end closed', 'temporary failure in name resolution', 'network is unreachable',
+                 'incompleteread']),
+]
+
+
+def _error_chain(err):
+    """The exception plus whatever it wraps (DownloadError.exc_info, ExtractorError.cause)"""
+    chain = []
+    while err is not None and err not in chain:
+        chain.append(err)
+        exc_info = getattr(err, 'exc_info', None)
+        err = (exc_info[1] if exc_info else None) or getattr(err, 'cause', None)
+    return chain
+
+
+def classify_error(err):
+    """Classify a yt-dlp exception as permanent, transient, rate-limited or fallback"""
+    for cause in _error_chain(err):
+        if isinstance(cause, (yt_dlp.utils.GeoRestrictedError, yt_dlp.utils.UnsupportedError)):
+            return PERMANENT
+        if isinstance(cause, (DownloadAborted, yt_dlp.utils.PostProcessingError)):
+            return FALLBACK
+
+        status = getattr(cause, 'status', None) or getattr(cause, 'code', None)
+        if status == 429:
+            return RATE_LIMITED
+        if isinstance(status, int) and 500 <= status < 600:
+            return SERVER_ERROR
+
+        if isinstance(cause, (yt_dlp.networking.exceptions.TransportError, ConnectionError, TimeoutError)):
+            return TRANSIENT
+        if isinstance(cause, OSError):
+            # Disk full, permissions and the like; retrying won't help
+            return FALLBACK
+
+    message = str(err).lower()
+    for kind, patterns in ERROR_PATTERNS:
+        if any(p in message for p in patterns):
+            return kind
+    return FALLBACK
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Per-platform breaker that pauses downloads while a site is throttling us"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.cooldown = BREAKER_COOLDOWN
+        self.stats = {'attempts': 0, 'successes': 0, PERMANENT: 0, TRANSIENT: 0,
+                      SERVER_ERROR: 0, RATE_LIMITED: 0, FALLBACK: 0, 'breaker_trips': 0}
+
+    def retry_after(self):
+        """Seconds until a trial request is allowed, 0 if closed"""
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at + self.cooldown - time.time(), 0)
+
+    def record_success(self):
+        with self.lock:
+            self.stats['attempts'] += 1
+            self.stats['successes'] += 1
+            self.failures = 0
+            if self.opened_at is not None:
+                self.opened_at = None
+                self.cooldown = BREAKER_COOLDOWN
+
+    def record_failure(self, kind):
+        with self.lock:
+            self.stats['attempts'] += 1
+            self.stats[kind] += 1
+            # Only the site throttling or failing counts; an offline phone isn't the site's fault
+            if kind not in (RATE_LIMITED, SERVER_ERROR):
+                return
+            self.failures += 1
+            if self.opened_at is not None:
+                # Trial request after cooldown failed, back off harder
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+                self.opened_at = time.time()
+                self.stats['breaker_trips'] += 1
+            elif self.failures >= BREAKER_THRESHOLD or kind == RATE_LIMITED:
+                self.opened_at = time.time()
+                self.stats['breaker_trips'] += 1
+
+    def to_dict(self):
+        attempts = self.stats['attempts']
+        failed = attempts - self.stats['successes']
+        return {
+            **self.stats,
+            'failure_rate': round(failed / attempts, 3) if attempts else 0.0,
+            'state': 'open' if self.retry_after() > 0 else ('half_open' if self.opened_at else 'closed'),
+            'retry_after': round(self.retry_after(), 1),
+        }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(platform):
+    with _breakers_lock:
+        if platform not in _breakers:
+            _breakers[platform] = CircuitBreaker()
+        return _breakers[platform]
+
+
+def get_retry_stats():
+    """Failure counters and breaker state per platform, as JSON"""
+    with _breakers_lock:
+        return json.dumps({p: b.to_dict() for p, b in _breakers.items()})
+
+
 def download_video(url, output_dir, progress_callback=None):
     """
     Download video from URL to specified directory
@@ -161,6 +342,17 @@ def download_video(url, output_dir, progress_callback=None):
                 'logs': logger.get_logs()
             })
 
+        # Free space check
+        free_bytes = shutil.disk_usage(output_dir).free - MIN_FREE_BYTES
+        logger.log(f"Usable free space: {free_bytes / 1024 / 1024:.1f} MB")
+        if free_bytes <= 0:
+            logger.error("Not enough free space")
+            return json.dumps({
+                'success': False,
+                'error': "Not enough free storage space",
+                'logs': logger.get_logs()
+            })
+
         platform = detect_platform(url)
         logger.log(f"Platform: {platform}")
 
@@ -233,37 +425,95 @@ def download_video(url, output_dir, progress_callback=None):
             'best',
         ]
 
-        for fmt_idx, fmt in enumerate(fallback_formats):
-            if fmt is None:
-                continue
-            try:
+        # Pause while this platform's circuit breaker is open
+        breaker = get_breaker(platform)
+        wait = breaker.retry_after()
+        if wait > BREAKER_MAX_WAIT:
+            logger.error(f"{platform} is throttling requests, retry in {wait:.0f}s")
+            return json.dumps({
+                'success': False,
+                'error': f"{platform} is rate limiting downloads",
+                'error_kind': RATE_LIMITED,
+                'retry_after': round(wait),
+                'logs': logger.get_logs()
+            })
+        if wait > 0:
+            logger.log(f"{platform} is throttling requests, pausing {wait:.0f}s...")
+            time.sleep(wait)
+
+        slot = writer_slot(abs_output_dir)
+        if not slot.acquire(blocking=False):
+            logger.log("Another download is writing to this storage, waiting...")
+            slot.acquire()
+
+        error_kind = None
+        try:
+            for fmt_idx, fmt in enumerate(fallback_formats):
+                if fmt is None:
+                    continue
                 ydl_opts['format'] = fmt
-                logger.log(f"Attempt {fmt_idx + 1}: Trying format '{fmt}'")
 
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    logger.log("Calling extract_info with download=True...")
-                    info = ydl.extract_info(url, download=True)
-                    if info:
+                for attempt in range(MAX_TRANSIENT_RETRIES):
+                    try:
+                        logger.log(f"Attempt {fmt_idx + 1}.{attempt + 1}: Trying format '{fmt}'")
+
+                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                            logger.log("Calling extract_info with download=False...")
+                            probed = ydl.extract_info(url, download=False)
+
+                            # Check space now that we hold the writer slot and know the size
+                            needed = expected_size(probed)
+                            free_bytes = shutil.disk_usage(abs_output_dir).free - MIN_FREE_BYTES
+                            logger.log(f"Expected size: {needed / 1024 / 1024:.1f} MB, "
+                                       f"usable free: {free_bytes / 1024 / 1024:.1f} MB")
+                            if needed > free_bytes:
+                                raise DownloadAborted(
+                                    f"Not enough storage: needs {needed / 1024 / 1024:.1f} MB, "
+                                    f"{max(free_bytes, 0) / 1024 / 1024:.1f} MB available")
+
+                            logger.log("Downloading selected format...")
+                            probed = yt_dlp.YoutubeDL.sanitize_info(dict(probed), remove_private_keys=True)
+                            result = ydl.process_ie_result(probed, download=True)
+
+                        written = [d.get('filepath') for d in (result or {}).get('requested_downloads') or []]
+                        if not written or not all(p and os.path.exists(p) for p in written):
+                            raise DownloadAborted("Download finished without writing a file")
+
+                        info = result
+                        breaker.record_success()
                         logger.log(f"Success with format: {fmt}")
                         break
-            except Exception as extract_err:
-                last_error = extract_err
-                error_str = str(extract_err).lower()
-                logger.warning(f"Format '{fmt}' failed: {extract_err}")
-
-                # If it's a format availability issue, try next format
-                if 'requested format' in error_str or 'format' in error_str or 'not available' in error_str:
-                    logger.log("Format not available, trying fallback...")
-                    continue
-                # For other errors, also try fallback but log the traceback
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                continue
+                    except Exception as extract_err:
+                        last_error = extract_err
+                        error_kind = classify_error(extract_err)
+                        breaker.record_failure(error_kind)
+                        logger.warning(f"Format '{fmt}' failed ({error_kind}): {extract_err}")
+
+                        if error_kind not in (TRANSIENT, SERVER_ERROR) or attempt + 1 == MAX_TRANSIENT_RETRIES:
+                            break
+                        if breaker.retry_after() > 0:
+                            break
+                        delay = backoff_delay(attempt)
+                        logger.log(f"Transient error, retrying in {delay:.1f}s...")
+                        time.sleep(delay)
+
+                if info is not None:
+                    break
+                # Retrying other formats won't help with these
+                if error_kind in (PERMANENT, RATE_LIMITED) or breaker.retry_after() > 0:
+                    logger.log(f"Giving up: {error_kind} error")
+                    break
+                logger.log("Trying fallback format...")
+        finally:
+            slot.release()
 
         if info is None:
             logger.error(f"All format attempts failed. Last error: {last_error}")
             return json.dumps({
                 'success': False,
-                'error': f"Download failed after trying all formats: {last_error}",
+                'error': f"Download failed: {last_error}",
+                'error_kind': error_kind,
+                'retry_after': round(breaker.retry_after()),
                 'logs': logger.get_logs()
             })
 
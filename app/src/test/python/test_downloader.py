@@ -0,0 +1,209 @@
+"""
+Tests for the Android downloader module
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+
+import pytest
+import yt_dlp
+
+import downloader
+
+URL = 'https://www.instagram.com/reel/abc123/'
+
+
+def make_info(filesize=1000):
+    return {
+        'id': 'abc123',
+        'title': 'Test Reel',
+        'duration': 10,
+        'extractor': 'instagram',
+        'extractor_key': 'Instagram',
+        'webpage_url': URL,
+        'formats': [{
+            'format_id': '1',
+            'ext': 'mp4',
+            'height': 720,
+            'vcodec': 'avc1',
+            'acodec': 'mp4a',
+            'filesize': filesize,
+            'url': 'https://example.com/1.mp4',
+            'protocol': 'https',
+        }],
+    }
+
+
+@pytest.fixture
+def fake_extract(monkeypatch):
+    """Serve a canned info dict instead of hitting the network"""
+    state = {'info': make_info()}
+
+    def extract_info(self, url, download=True, **kwargs):
+        return self.process_ie_result(dict(state['info']), download=download)
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'extract_info', extract_info)
+    return state
+
+
+def test_successful_download_reports_written_file(tmp_path, monkeypatch, fake_extract):
+    def process_info(self, info_dict):
+        path = self.prepare_filename(info_dict)
+        with open(path, 'w') as f:
+            f.write('video')
+        info_dict['filepath'] = path
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', process_info)
+
+    result = json.loads(downloader.download_video(URL, str(tmp_path)))
+
+    assert result['success'], result['error']
+    assert os.path.basename(result['filename']) == 'Test_Reel.mp4'
+
+
+def test_aborted_download_is_not_reported_as_success(tmp_path, monkeypatch, fake_extract):
+    # Simulate yt-dlp returning normally without writing, as max-filesize aborts do
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', lambda self, info_dict: None)
+    (tmp_path / 'older_download.mp4').write_text('unrelated')
+
+    result = json.loads(downloader.download_video(URL, str(tmp_path)))
+
+    assert not result['success']
+    assert 'without writing a file' in result['error']
+
+
+def test_download_larger_than_free_space_is_refused(tmp_path, monkeypatch, fake_extract):
+    fake_extract['info'] = make_info(filesize=10 ** 15)
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info',
+                        lambda self, info_dict: pytest.fail('should not download'))
+
+    result = json.loads(downloader.download_video(URL, str(tmp_path)))
+
+    assert not result['success']
+    assert 'Not enough storage' in result['error']
+
+
+def test_expected_size_sums_merged_formats():
+    info = {'duration': 10, 'requested_formats': [{'filesize': 100}, {'filesize_approx': 50}, {'tbr': 8}]}
+    assert downloader.expected_size(info) == 100 + 50 + 8 * 125 * 10
+
+
+def wrapped(exc):
+    """Wrap an exception the way YoutubeDL.extract_info reports it"""
+    return yt_dlp.utils.DownloadError(f'ERROR: {exc}', exc_info=(type(exc), exc, None))
+
+
+@pytest.mark.parametrize('err, kind', [
+    (Exception('ERROR: [youtube] abc: Requested format is not available'), downloader.FALLBACK),
+    (Exception('ERROR: You have requested merging of multiple formats but ffmpeg is not installed'),
+     downloader.FALLBACK),
+    (wrapped(yt_dlp.utils.PostProcessingError('Conversion failed!')), downloader.FALLBACK),
+    (wrapped(OSError(28, 'No space left on device')), downloader.FALLBACK),
+    (Exception('something nobody has seen before'), downloader.FALLBACK),
+    (Exception('ERROR: [youtube] abc: This video is not available'), downloader.PERMANENT),
+    (Exception('ERROR: [youtube] abc: Private video'), downloader.PERMANENT),
+    (wrapped(yt_dlp.utils.GeoRestrictedError('blocked')), downloader.PERMANENT),
+    (Exception('ERROR: HTTP Error 429: Too Many Requests'), downloader.RATE_LIMITED),
+    (Exception('ERROR: Unable to download webpage: HTTP Error 503: Service Unavailable'), downloader.SERVER_ERROR),
+    (Exception('ERROR: Unable to download webpage: [Errno 101] Network is unreachable'), downloader.TRANSIENT),
+    (wrapped(yt_dlp.networking.exceptions.TransportError('Read timed out')), downloader.TRANSIENT),
+    (wrapped(yt_dlp.utils.ExtractorError('Unable to download', cause=ConnectionResetError())),
+     downloader.TRANSIENT),
+])
+def test_classify_error(err, kind):
+    assert downloader.classify_error(err) == kind
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(downloader.time, 'time', lambda: now[0])
+    return now
+
+
+def test_breaker_opens_on_rate_limit_and_half_opens_after_cooldown(clock):
+    breaker = downloader.CircuitBreaker()
+    breaker.record_failure(downloader.RATE_LIMITED)
+    assert breaker.to_dict()['state'] == 'open'
+    assert breaker.retry_after() == downloader.BREAKER_COOLDOWN
+
+    clock[0] += downloader.BREAKER_COOLDOWN
+    assert breaker.to_dict()['state'] == 'half_open'
+
+    breaker.record_success()
+    assert breaker.to_dict()['state'] == 'closed'
+
+
+def test_breaker_failed_trial_doubles_cooldown(clock):
+    breaker = downloader.CircuitBreaker()
+    breaker.record_failure(downloader.RATE_LIMITED)
+    clock[0] += downloader.BREAKER_COOLDOWN
+
+    breaker.record_failure(downloader.SERVER_ERROR)
+
+    assert breaker.retry_after() == 2 * downloader.BREAKER_COOLDOWN
+    assert breaker.stats['breaker_trips'] == 2
+
+
+def test_breaker_needs_consecutive_server_errors(clock):
+    breaker = downloader.CircuitBreaker()
+    for _ in range(downloader.BREAKER_THRESHOLD - 1):
+        breaker.record_failure(downloader.SERVER_ERROR)
+    assert breaker.to_dict()['state'] == 'closed'
+
+    breaker.record_failure(downloader.SERVER_ERROR)
+    assert breaker.to_dict()['state'] == 'open'
+
+
+def test_offline_device_retries_without_tripping_breaker(tmp_path, monkeypatch):
+    attempts = []
+
+    def extract_info(self, url, download=True, **kwargs):
+        attempts.append(url)
+        raise yt_dlp.utils.DownloadError('ERROR: Unable to download webpage: [Errno 101] Network is unreachable')
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'extract_info', extract_info)
+    monkeypatch.setattr(downloader.time, 'sleep', lambda s: None)
+    url = 'https://www.youtube.com/watch?v=offline0000'
+
+    result = json.loads(downloader.download_video(url, str(tmp_path)))
+
+    assert not result['success']
+    assert result['error_kind'] == downloader.TRANSIENT
+    # Backed off and retried, but the platform is not marked as throttling
+    assert len(attempts) > downloader.BREAKER_THRESHOLD
+    assert downloader.get_breaker('youtube').to_dict()['state'] == 'closed'
+
+
+def test_breaker_ignores_fallback_and_permanent_errors(clock):
+    breaker = downloader.CircuitBreaker()
+    for _ in range(10):
+        breaker.record_failure(downloader.FALLBACK)
+        breaker.record_failure(downloader.PERMANENT)
+
+    stats = breaker.to_dict()
+    assert stats['state'] == 'closed'
+    assert stats['failure_rate'] == 1.0
+    assert stats['fallback'] == 10
+
+
+def test_local_error_falls_back_without_retry_or_breaker(tmp_path, monkeypatch, fake_extract):
+    formats_tried = []
+
+    def process_info(self, info_dict):
+        formats_tried.append(self.params['format'])
+        raise yt_dlp.utils.PostProcessingError('Conversion failed!')
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', process_info)
+    monkeypatch.setattr(downloader.time, 'sleep', lambda s: pytest.fail('should not back off'))
+
+    result = json.loads(downloader.download_video(URL, str(tmp_path)))
+
+    assert not result['success']
+    assert result['error_kind'] == downloader.FALLBACK
+    # One attempt per fallback format, and the platform stays usable
+    assert len(formats_tried) == len(set(formats_tried)) > 1
+    assert downloader.get_breaker('instagram').retry_after() == 0
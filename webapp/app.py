@@ -3,15 +3,28 @@ Zingy Web App - Flask server with yt-dlp backend
 Runs on port 4321
 """
 
+import io
 import os
 import json
+import queue
+import hashlib
+import math
+import shutil
+import time
 import uuid
 import threading
+import urllib.parse
+import urllib.request
 from datetime import datetime
 from flask import Flask, render_template, request, jsonify, send_from_directory
 from flask_cors import CORS
 import yt_dlp
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend on different port
 
@@ -19,6 +32,23 @@ CORS(app)  # Enable CORS for frontend on different port
 DOWNLOAD_DIR = os.path.expanduser("~/Downloads/Zingy")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+# Storage admission
+MIN_FREE_BYTES = 500 * 1024 * 1024  # Always leave this much free on the device
+# Cap on DOWNLOAD_DIR usage, set with ZINGY_QUOTA_MB; 0 disables
+DOWNLOAD_QUOTA_BYTES = int(float(os.environ.get('ZINGY_QUOTA_MB', '0')) * 1024 * 1024)
+MAX_WRITERS_PER_DEVICE = 2  # Concurrent downloads writing to one storage device
+
+# Local thumbnail cache
+THUMBNAIL_SIZE = (320, 180)
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60  # Content-addressed, so safe to cache forever
+THUMBNAIL_MAX_BYTES = 5 * 1024 * 1024  # Refuse anything bigger than a sane thumbnail
+THUMBNAIL_TYPES = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+}
+
 # Track downloads in progress
 downloads = {}
 downloads_lock = threading.Lock()
@@ -41,6 +71,9 @@ class DownloadProgress:
 
         if status == 'downloading':
             self.status = "downloading"
+            for key in ('tmpfilename', 'filename'):
+                if d.get(key):
+                    admission.track_file(self.download_id, d[key])
             total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
             downloaded = d.get('downloaded_bytes', 0)
 
@@ -64,6 +97,9 @@ class DownloadProgress:
             self.status = "error"
             self.error = str(d.get('error', 'Unknown error'))
 
+    def mark_queued(self):
+        self.status = "queued"
+
     def to_dict(self):
         return {
             'id': self.download_id,
@@ -77,6 +113,241 @@ class DownloadProgress:
         }
 
 
+class StorageAdmission:
+    """Reserve disk space and writer slots before a download starts"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.reservations = {}  # download_id -> (device, bytes)
+        self.files = {}  # download_id -> paths the job is writing
+        self.writers = {}  # device -> active writer count
+        self.cond = threading.Condition()
+
+    def _device(self):
+        return os.stat(self.directory).st_dev
+
+    def _used_bytes(self):
+        total = 0
+        for filename in os.listdir(self.directory):
+            filepath = os.path.join(self.directory, filename)
+            if os.path.isfile(filepath):
+                total += os.path.getsize(filepath)
+        return total
+
+    def _written_bytes(self, device):
+        """Bytes admitted jobs have already written; their full size is in the reservation"""
+        total = 0
+        for download_id, paths in self.files.items():
+            if self.reservations.get(download_id, (None,))[0] != device:
+                continue
+            for path in paths:
+                if os.path.isfile(path):
+                    total += os.path.getsize(path)
+        return total
+
+    def _check(self, device, size):
+        """Return (fits_now, fits_ever, fits_quota) for a job of the given size"""
+        reserved = sum(b for d, b in self.reservations.values() if d == device)
+        written = self._written_bytes(device)
+        free = shutil.disk_usage(self.directory).free + written - MIN_FREE_BYTES
+        fits_now = size <= free - reserved
+        fits_ever = size <= free
+        fits_quota = True
+        if DOWNLOAD_QUOTA_BYTES:
+            used = self._used_bytes() - written
+            fits_now = fits_now and used + reserved + size <= DOWNLOAD_QUOTA_BYTES
+            fits_quota = used + size <= DOWNLOAD_QUOTA_BYTES
+        return fits_now, fits_ever, fits_quota
+
+    def track_file(self, download_id, path):
+        """Note a file an admitted job is writing, so it isn't counted on top of its reservation"""
+        with self.cond:
+            if download_id in self.reservations:
+                self.files.setdefault(download_id, set()).add(path)
+
+    def admit(self, download_id, size, on_queued=None):
+        """Block until the job fits, returning an error message if it never will"""
+        device = self._device()
+        with self.cond:
+            while True:
+                fits_now, fits_ever, fits_quota = self._check(device, size)
+                if not fits_ever:
+                    return (f"Not enough storage: needs {size / 1024 / 1024:.1f} MB, "
+                            f"{self.free_bytes() / 1024 / 1024:.1f} MB available")
+                if not fits_quota:
+                    return (f"Download quota exceeded: needs {size / 1024 / 1024:.1f} MB, "
+                            f"quota is {DOWNLOAD_QUOTA_BYTES / 1024 / 1024:.1f} MB")
+                if fits_now and self.writers.get(device, 0) < MAX_WRITERS_PER_DEVICE:
+                    break
+                if on_queued:
+                    on_queued()
+                self.cond.wait(timeout=5)
+
+            self.reservations[download_id] = (device, size)
+            self.writers[device] = self.writers.get(device, 0) + 1
+        return None
+
+    def release(self, download_id):
+        """Return a job's reservation and writer slot"""
+        with self.cond:
+            reservation = self.reservations.pop(download_id, None)
+            self.files.pop(download_id, None)
+            if reservation:
+                device = reservation[0]
+                self.writers[device] = max(self.writers.get(device, 1) - 1, 0)
+            self.cond.notify_all()
+
+    def free_bytes(self):
+        """Usable free space after reservations and the safety margin"""
+        device = self._device()
+        reserved = sum(b for d, b in self.reservations.values() if d == device)
+        free = shutil.disk_usage(self.directory).free + self._written_bytes(device)
+        return max(free - MIN_FREE_BYTES - reserved, 0)
+
+
+admission = StorageAdmission(DOWNLOAD_DIR)
+
+
+class MediaLibrary:
+    """Local thumbnail cache and per-file metadata sidecar index"""
+    def __init__(self, directory):
+        self.thumb_dir = os.path.join(directory, '.zingy', 'thumbs')
+        self.index_path = os.path.join(directory, '.zingy', 'index.json')
+        os.makedirs(self.thumb_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = self._load()
+        self.queue = queue.Queue()
+        self.pending = set()
+
+        worker = threading.Thread(target=self._worker)
+        worker.daemon = True
+        worker.start()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('files', {})
+        index.setdefault('thumbnails', {})
+        return index
+
+    def _save(self):
+        # Write-then-rename so a crash never leaves a truncated index
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def thumbnail_path(self, thumbnail_url):
+        """Local URL of a cached thumbnail, or '' if not fetched yet"""
+        with self.lock:
+            name = self.index['thumbnails'].get(thumbnail_url)
+        return f"/thumbs/{name}" if name else ''
+
+    def prefetch(self, thumbnail_url):
+        """Queue a thumbnail for background download"""
+        if not is_remote_url(thumbnail_url) or self.thumbnail_path(thumbnail_url):
+            return
+        with self.lock:
+            if thumbnail_url in self.pending:
+                return
+            self.pending.add(thumbnail_url)
+        self.queue.put(thumbnail_url)
+
+    def _worker(self):
+        while True:
+            thumbnail_url = self.queue.get()
+            try:
+                self._fetch(thumbnail_url)
+            except Exception as e:
+                app.logger.warning("Thumbnail fetch failed for %s: %s", thumbnail_url, e)
+            finally:
+                with self.lock:
+                    self.pending.discard(thumbnail_url)
+
+    def _fetch(self, thumbnail_url):
+        if not is_remote_url(thumbnail_url):
+            raise ValueError("thumbnail URL must be http or https")
+        req = urllib.request.Request(thumbnail_url, headers={'User-Agent': 'Mozilla/5.0'})
+        with urllib.request.urlopen(req, timeout=15) as resp:
+            content_type = resp.headers.get_content_type()
+            data = resp.read(THUMBNAIL_MAX_BYTES + 1)
+
+        if len(data) > THUMBNAIL_MAX_BYTES:
+            raise ValueError(f"thumbnail larger than {THUMBNAIL_MAX_BYTES} bytes")
+        if content_type not in THUMBNAIL_TYPES:
+            raise ValueError(f"unexpected content type {content_type}")
+
+        data, ext = resize_thumbnail(data, THUMBNAIL_TYPES[content_type])
+        name = hashlib.sha256(data).hexdigest()[:32] + ext
+        path = os.path.join(self.thumb_dir, name)
+
+        # Write under the lock so forget() can't collect it before it is indexed
+        with self.lock:
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(data)
+            self.index['thumbnails'][thumbnail_url] = name
+            self._save()
+
+    def record(self, filename, metadata):
+        """Store metadata for a downloaded file"""
+        with self.lock:
+            self.index['files'][filename] = metadata
+            self._save()
+        self.prefetch(metadata.get('thumbnail_url'))
+
+    def lookup(self, filename):
+        """Metadata for a file, with the thumbnail resolved to the local cache"""
+        with self.lock:
+            metadata = dict(self.index['files'].get(filename, {}))
+        if metadata:
+            metadata['thumbnail'] = self.thumbnail_path(metadata.get('thumbnail_url'))
+        return metadata
+
+    def forget(self, filename):
+        """Drop a deleted file's metadata and any thumbnails nothing references anymore"""
+        with self.lock:
+            self.index['files'].pop(filename, None)
+
+            # Probe-only thumbnails go too, so the cache only holds what the files list shows
+            referenced = {m.get('thumbnail_url') for m in self.index['files'].values()}
+            thumbnails = self.index['thumbnails']
+            for url in [u for u in thumbnails if u not in referenced]:
+                del thumbnails[url]
+
+            # Content-addressed, so one file can back several URLs
+            kept = set(thumbnails.values())
+            for name in os.listdir(self.thumb_dir):
+                if name not in kept:
+                    os.remove(os.path.join(self.thumb_dir, name))
+            self._save()
+
+
+def is_remote_url(url):
+    """Only fetch http(s) thumbnails; extractors can hand back file:// or other schemes"""
+    return bool(url) and urllib.parse.urlsplit(url).scheme in ('http', 'https')
+
+
+def resize_thumbnail(data, ext):
+    """Downscale thumbnail bytes to JPEG, or return them untouched without Pillow"""
+    if Image is None:
+        return data, ext
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert('RGB')
+            img.thumbnail(THUMBNAIL_SIZE)
+            out = io.BytesIO()
+            img.save(out, 'JPEG', quality=80)
+            return out.getvalue(), '.jpg'
+    except Exception:
+        return data, ext
+
+
+library = MediaLibrary(DOWNLOAD_DIR)
+
+
 def detect_platform(url):
     """Detect video platform from URL"""
     url_lower = url.lower()
@@ -92,71 +363,275 @@ def detect_platform(url):
         return 'unknown'
 
 
+# Format ranking
+# Relative encoding efficiency per codec family (higher = smaller files at the same quality)
+CODEC_EFFICIENCY = {
+    'av01': 1.0,
+    'vp09': 0.8,
+    'vp9': 0.8,
+    'hev1': 0.8,
+    'hvc1': 0.8,
+    'avc1': 0.5,
+    'h264': 0.5,
+}
+
+# Most a bloated bitrate can cost; a resolution step is worth ~0.117
+BITRATE_PENALTY_CAP = 0.1
+
+# Named selection policies that can be sent with a download request
+POLICY_FIELDS = {
+    'max_height': int,
+    'max_size_mb': (int, float),
+    'allow_merge': bool,
+    'video': bool,
+    'prefer': str,
+}
+
+FORMAT_POLICIES = {
+    'best': {},
+    'smallest_50mb': {'prefer': 'smallest', 'max_size_mb': 50},
+    'best_720p_no_merge': {'max_height': 720, 'allow_merge': False},
+}
+
+# Audio containers that merge cleanly into each video container
+COMPATIBLE_AUDIO = {
+    'mp4': ('m4a', 'mp4'),
+    'webm': ('webm',),
+}
+
+# Merged formats are only offered when ffmpeg can do the merge
+FFMPEG_AVAILABLE = shutil.which('ffmpeg') is not None
+
+# Fallback chain appended to ranked picks in case the chosen format fails
+DEFAULT_FALLBACK = 'best[ext=mp4]/best'
+YOUTUBE_FALLBACK = '/'.join([
+    'best[ext=mp4][acodec!=none][vcodec!=none]',
+    'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]',
+    '22', '18',
+    'best[vcodec!=none][acodec!=none]',
+    'best',
+])
+
+# Probed info dicts and their ranked tables, keyed by URL
+FORMAT_CACHE_TTL = 30 * 60
+FORMAT_CACHE_MAX = 32
+format_cache = {}
+format_cache_lock = threading.Lock()
+
+
+def codec_efficiency(vcodec):
+    """Look up the efficiency weight for a yt-dlp vcodec string"""
+    family = (vcodec or '').split('.')[0].lower()
+    return CODEC_EFFICIENCY.get(family, 0.4)
+
+
+def estimate_size(fmt, duration):
+    """Best guess of a format's size in bytes, or 0 if unknown"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    tbr = fmt.get('tbr') or 0
+    if tbr and duration:
+        return int(tbr * 125 * duration)  # kbit/s -> bytes
+    return 0
+
+
+def needed_bitrate(height, vcodec):
+    """Rough kbit/s a codec needs for good quality at a given height (plus audio)"""
+    # ~2500 kbit/s for 720p H.264, scaling with pixel count
+    video = 2500 * (max(height, 144) / 720) ** 2
+    return video * CODEC_EFFICIENCY['avc1'] / codec_efficiency(vcodec) + 128
+
+
+def score_format(entry):
+    """Score a ranked entry; higher is better"""
+    if not entry['has_video']:
+        return 0.1 * min(entry['tbr'], 320) / 320
+
+    score = 0.7 * min(entry['height'], 2160) / 2160
+    score += 0.15 * codec_efficiency(entry['vcodec'])
+    score += 0.05 * min(entry['tbr'], 10000) / 10000
+    excess = entry['tbr'] / needed_bitrate(entry['height'], entry['vcodec'])
+    if excess > 1:
+        # Penalise bitrate beyond what the resolution needs; capped below one
+        # resolution step so it only reorders formats of similar quality
+        score -= min(0.1 * math.log2(excess), BITRATE_PENALTY_CAP)
+    if entry['needs_merge']:
+        score -= 0.05
+    return round(score, 4)
+
+
+def rank_formats(info, merge=True):
+    """Build the scored format table for an info dict"""
+    duration = info.get('duration') or 0
+    formats = info.get('formats') or []
+
+    audio_only = [f for f in formats if f.get('vcodec', 'none') == 'none' and f.get('acodec', 'none') != 'none']
+    audio_rank = lambda f: f.get('abr') or f.get('tbr') or 0
+
+    best = {}
+    for f in formats:
+        vcodec = f.get('vcodec', 'none')
+        acodec = f.get('acodec', 'none')
+        has_video = vcodec != 'none'
+        has_audio = acodec != 'none'
+
+        # Skip if no video and no audio
+        if not has_video and not has_audio:
+            continue
+
+        format_id = f.get('format_id', '')
+        ext = f.get('ext', 'unknown')
+        height = f.get('height') or 0
+        tbr = f.get('tbr') or 0
+        size = estimate_size(f, duration)
+        needs_merge = has_video and not has_audio
+
+        if needs_merge:
+            # Pair with audio in a container the video can be merged into
+            compatible = COMPATIBLE_AUDIO.get(ext, ())
+            best_audio = max((a for a in audio_only if a.get('ext') in compatible), key=audio_rank, default=None)
+            if not merge or best_audio is None:
+                continue
+            format_id = f"{format_id}+{best_audio.get('format_id', '')}"
+            tbr += best_audio.get('tbr') or best_audio.get('abr') or 0
+            audio_size = estimate_size(best_audio, duration)
+            size = size + audio_size if size and audio_size else 0
+            has_audio = True
+
+        if has_video:
+            resolution = f.get('resolution') or f"{height}p"
+            label = f"{resolution} ({ext}) - Video+Audio" + (" (merged)" if needs_merge else "")
+        else:
+            label = f"Audio ({ext})"
+        if size:
+            label += f" ~{size / 1024 / 1024:.1f} MB"
+
+        entry = {
+            'id': format_id,
+            'label': label,
+            'ext': ext,
+            'height': height,
+            'has_video': has_video,
+            'has_audio': has_audio,
+            'vcodec': vcodec,
+            'tbr': tbr,
+            'filesize': size,
+            'needs_merge': needs_merge,
+        }
+        entry['score'] = score_format(entry)
+
+        # Deduplicate, keeping the best-scoring format per bucket
+        key = (height, ext, has_video, needs_merge)
+        if key not in best or entry['score'] > best[key]['score']:
+            best[key] = entry
+
+    # Audio-only entries are scored on their own scale, so always list video first
+    return sorted(best.values(), key=lambda x: (x['has_video'], x['score']), reverse=True)
+
+
+def select_format(table, policy=None):
+    """Resolve a policy against a ranked table, returning the chosen entry or None"""
+    policy = policy or {}
+    max_height = policy.get('max_height')
+    max_size_mb = policy.get('max_size_mb')
+    allow_merge = policy.get('allow_merge', True)
+    want_video = policy.get('video', True)
+
+    candidates = []
+    for entry in table:
+        if entry['has_video'] != want_video:
+            continue
+        if max_height and entry['height'] > max_height:
+            continue
+        if not allow_merge and entry['needs_merge']:
+            continue
+        if max_size_mb and (not entry['filesize'] or entry['filesize'] > max_size_mb * 1024 * 1024):
+            continue
+        candidates.append(entry)
+
+    if not candidates:
+        return None
+    if policy.get('prefer') == 'smallest':
+        return min(candidates, key=lambda x: x['filesize'] or float('inf'))
+    return candidates[0]
+
+
+def cache_formats(url, info):
+    """Rank an info dict and remember both for the follow-up download"""
+    table = rank_formats(info, merge=FFMPEG_AVAILABLE)
+    now = time.time()
+    with format_cache_lock:
+        # Sweep stale probes and keep at most FORMAT_CACHE_MAX of the newest
+        for key in [k for k, v in format_cache.items() if now - v['time'] > FORMAT_CACHE_TTL]:
+            del format_cache[key]
+        format_cache.pop(url, None)
+        while len(format_cache) >= FORMAT_CACHE_MAX:
+            del format_cache[min(format_cache, key=lambda k: format_cache[k]['time'])]
+        format_cache[url] = {'info': info, 'table': table, 'time': now}
+    return table
+
+
+def get_cached_formats(url):
+    """Return the cached (info, table) for a URL, or (None, None) if missing or stale"""
+    with format_cache_lock:
+        cached = format_cache.get(url)
+        if cached and time.time() - cached['time'] > FORMAT_CACHE_TTL:
+            del format_cache[url]
+            cached = None
+    if not cached:
+        return None, None
+    return cached['info'], cached['table']
+
+
+def platform_opts(platform):
+    """Extractor options shared by probing and downloading"""
+    if platform == 'youtube':
+        return {'extractor_args': {'youtube': {'player_client': ['android', 'web']}}}
+    elif platform == 'instagram':
+        return {'extractor_args': {'instagram': {'skip': ['dash']}}}
+    return {}
+
+
+def probe_formats(url):
+    """Extract info without downloading and cache its ranked format table"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        **platform_opts(detect_platform(url)),
+    }
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    return info, cache_formats(url, info)
+
+
 def get_available_formats(url):
     """Get available formats for a video"""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-        }
+        info, table = probe_formats(url)
+        thumbnail = info.get('thumbnail', '')
+        library.prefetch(thumbnail)
+
+        # Add common presets at top
+        presets = [
+            {'id': 'best', 'label': 'Best Quality (Auto)', 'ext': 'mp4', 'height': 9999, 'has_video': True, 'has_audio': True},
+            {'id': 'best[ext=mp4]', 'label': 'Best MP4', 'ext': 'mp4', 'height': 9998, 'has_video': True, 'has_audio': True},
+            {'id': 'policy:smallest_50mb', 'label': 'Smallest under 50 MB', 'ext': 'mp4', 'height': 0, 'has_video': True, 'has_audio': True},
+            {'id': 'policy:best_720p_no_merge', 'label': 'Best up to 720p (no merge)', 'ext': 'mp4', 'height': 720, 'has_video': True, 'has_audio': True},
+            {'id': 'bestaudio', 'label': 'Audio Only (Best)', 'ext': 'm4a', 'height': 0, 'has_video': False, 'has_audio': True},
+        ]
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-
-            formats = []
-            seen = set()
-
-            if 'formats' in info:
-                for f in info['formats']:
-                    format_id = f.get('format_id', '')
-                    ext = f.get('ext', 'unknown')
-                    resolution = f.get('resolution', 'audio only')
-                    height = f.get('height', 0)
-                    vcodec = f.get('vcodec', 'none')
-                    acodec = f.get('acodec', 'none')
-
-                    # Skip if no video and no audio
-                    if vcodec == 'none' and acodec == 'none':
-                        continue
-
-                    # Create display label
-                    if vcodec != 'none' and acodec != 'none':
-                        label = f"{resolution} ({ext}) - Video+Audio"
-                    elif vcodec != 'none':
-                        label = f"{resolution} ({ext}) - Video only"
-                    else:
-                        label = f"Audio ({ext})"
-
-                    # Deduplicate
-                    key = f"{height}_{ext}_{vcodec != 'none'}_{acodec != 'none'}"
-                    if key not in seen:
-                        seen.add(key)
-                        formats.append({
-                            'id': format_id,
-                            'label': label,
-                            'ext': ext,
-                            'height': height or 0,
-                            'has_video': vcodec != 'none',
-                            'has_audio': acodec != 'none'
-                        })
-
-            # Sort by height (resolution) descending
-            formats.sort(key=lambda x: (x['has_video'], x['height']), reverse=True)
-
-            # Add common presets at top
-            presets = [
-                {'id': 'best', 'label': 'Best Quality (Auto)', 'ext': 'mp4', 'height': 9999, 'has_video': True, 'has_audio': True},
-                {'id': 'best[ext=mp4]', 'label': 'Best MP4', 'ext': 'mp4', 'height': 9998, 'has_video': True, 'has_audio': True},
-                {'id': 'bestaudio', 'label': 'Audio Only (Best)', 'ext': 'm4a', 'height': 0, 'has_video': False, 'has_audio': True},
-            ]
-
-            return {
-                'success': True,
-                'title': info.get('title', 'Unknown'),
-                'thumbnail': info.get('thumbnail', ''),
-                'duration': info.get('duration', 0),
-                'formats': presets + formats[:20]  # Limit to 20 formats
-            }
+        return {
+            'success': True,
+            'title': info.get('title', 'Unknown'),
+            'thumbnail': thumbnail,
+            'thumbnail_local': library.thumbnail_path(thumbnail),
+            'duration': info.get('duration', 0),
+            'formats': presets + table[:20]  # Limit to 20 formats
+        }
 
     except Exception as e:
         return {
@@ -165,19 +640,100 @@ def get_available_formats(url):
         }
 
 
-def download_video_task(download_id, url, format_id):
+def validate_policy(policy):
+    """Return an error message if a client-supplied policy is malformed"""
+    if policy is None:
+        return None
+    if not isinstance(policy, dict):
+        return 'Policy must be an object'
+    for key, value in policy.items():
+        expected = POLICY_FIELDS.get(key)
+        if expected is None:
+            return f"Unknown policy field '{key}'"
+        # bool is an int subclass, so check it explicitly
+        if isinstance(value, bool) != (expected is bool) or not isinstance(value, expected):
+            return f"Policy field '{key}' has the wrong type"
+    if policy.get('prefer', 'best') not in ('best', 'smallest'):
+        return "Policy field 'prefer' must be 'best' or 'smallest'"
+    return None
+
+
+def fresh_info(info):
+    """Copy of a probed info dict with the probe's own format selection stripped"""
+    clean = yt_dlp.YoutubeDL.sanitize_info(dict(info), remove_private_keys=True)
+    if not clean.get('formats'):
+        # Single-format results keep their only media URL at the top level
+        return clean
+    selected = set().union(*(f.keys() for f in clean['formats']))
+    for key in (selected | {'format', 'format_id', 'ext', 'url'}) - {'formats', 'id', 'title', 'duration'}:
+        clean.pop(key, None)
+    return clean
+
+
+def estimate_download_size(info, format_spec):
+    """Bytes yt-dlp would fetch for a format spec, from the probe's size fields"""
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'format': format_spec}) as ydl:
+        selected = ydl.process_ie_result(fresh_info(info), download=False)
+    duration = info.get('duration') or 0
+    return sum(estimate_size(f, duration) for f in selected.get('requested_formats') or [selected])
+
+
+def resolve_format(table, format_id, policy=None):
+    """Turn a requested format id or policy into a concrete ranked entry"""
+    if policy is None and format_id and format_id.startswith('policy:'):
+        policy = FORMAT_POLICIES.get(format_id.split(':', 1)[1])
+    if policy is None and format_id in ('best', None):
+        policy = FORMAT_POLICIES['best']
+    if policy is not None:
+        return select_format(table, policy)
+    for entry in table:
+        if entry['id'] == format_id:
+            return entry
+    return None
+
+
+def download_video_task(download_id, url, format_id, policy=None):
     """Background task to download video"""
     progress = downloads.get(download_id)
     if not progress:
         return
 
+    admitted = False
     try:
         platform = detect_platform(url)
 
+        # Reuse the probe from /api/formats so formats are negotiated once
+        info, table = get_cached_formats(url)
+        if info is None:
+            info, table = probe_formats(url)
+
+        fallback = YOUTUBE_FALLBACK if platform == 'youtube' else DEFAULT_FALLBACK
+        is_policy = policy is not None or (format_id or '').startswith('policy:')
+        choice = resolve_format(table, format_id, policy)
+        if choice and is_policy:
+            # Policies are hard constraints, so no fallback that could break them
+            format_spec = choice['id']
+        elif choice:
+            format_spec = f"{choice['id']}/{fallback}"
+        elif is_policy:
+            raise ValueError('No format matches the requested policy')
+        elif platform == 'youtube' and format_id in ['best', 'best[ext=mp4]', None]:
+            format_spec = YOUTUBE_FALLBACK
+        else:
+            format_spec = format_id or DEFAULT_FALLBACK
+
+        # Reserve space for the resolved format before writing anything
+        expected_size = estimate_download_size(info, format_spec)
+        error = admission.admit(download_id, expected_size, on_queued=progress.mark_queued)
+        if error:
+            raise ValueError(error)
+        admitted = True
+        progress.status = "starting"
+
         outtmpl = os.path.join(DOWNLOAD_DIR, '%(title).80s.%(ext)s')
 
         ydl_opts = {
-            'format': format_id or 'best[ext=mp4]/best',
+            'format': format_spec,
             'outtmpl': outtmpl,
             'progress_hooks': [progress.hook],
             'quiet': True,
@@ -187,33 +743,38 @@ def download_video_task(download_id, url, format_id):
             'socket_timeout': 30,
             'retries': 3,
             'restrictfilenames': True,
+            **platform_opts(platform),
         }
 
-        # Platform-specific options
-        if platform == 'youtube':
-            format_options = [
-                'best[ext=mp4][acodec!=none][vcodec!=none]',
-                'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]',
-                '22', '18',
-                'best[vcodec!=none][acodec!=none]',
-                'best',
-            ]
-            if format_id in ['best', 'best[ext=mp4]', None]:
-                ydl_opts['format'] = '/'.join(format_options)
-            ydl_opts['extractor_args'] = {'youtube': {'player_client': ['android', 'web']}}
-        elif platform == 'instagram':
-            ydl_opts['extractor_args'] = {'instagram': {'skip': ['dash']}}
-
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+            info = ydl.process_ie_result(fresh_info(info), download=True)
             progress.title = info.get('title', 'Unknown')
-            progress.status = "completed"
             progress.filename = ydl.prepare_filename(info)
 
+        # Persist what we know so the files list never has to re-probe
+        requested = info.get('requested_downloads') or [{}]
+        filepath = requested[0].get('filepath')
+        if not filepath or not os.path.exists(filepath):
+            raise ValueError('Download finished without writing a file')
+        progress.filename = filepath
+        library.record(os.path.basename(filepath), {
+            'title': progress.title,
+            'duration': info.get('duration', 0),
+            'platform': platform,
+            'format': choice['label'] if choice else format_spec,
+            'url': url,
+            'thumbnail_url': info.get('thumbnail', ''),
+        })
+        progress.status = "completed"
+
     except Exception as e:
         progress.status = "error"
         progress.error = str(e)
 
+    finally:
+        if admitted:
+            admission.release(download_id)
+
 
 @app.route('/')
 def index():
@@ -245,10 +806,15 @@ def api_download():
     data = request.get_json()
     url = data.get('url', '').strip()
     format_id = data.get('format', 'best')
+    policy = data.get('policy')
 
     if not url:
         return jsonify({'success': False, 'error': 'URL is required'})
 
+    policy_error = validate_policy(policy)
+    if policy_error:
+        return jsonify({'success': False, 'error': f"Invalid policy: {policy_error}"}), 400
+
     platform = detect_platform(url)
     if platform == 'unknown':
         return jsonify({'success': False, 'error': 'Unsupported platform'})
@@ -260,7 +826,7 @@ def api_download():
         downloads[download_id] = progress
 
     # Start download in background thread
-    thread = threading.Thread(target=download_video_task, args=(download_id, url, format_id))
+    thread = threading.Thread(target=download_video_task, args=(download_id, url, format_id, policy))
     thread.daemon = True
     thread.start()
 
@@ -294,11 +860,17 @@ def api_files():
             filepath = os.path.join(DOWNLOAD_DIR, filename)
             if os.path.isfile(filepath):
                 stat = os.stat(filepath)
+                metadata = library.lookup(filename)
                 files.append({
                     'name': filename,
                     'size': stat.st_size,
                     'size_formatted': f"{stat.st_size / 1024 / 1024:.2f} MB",
                     'modified': datetime.fromtimestamp(stat.st_mtime).isoformat(),
+                    'title': metadata.get('title', ''),
+                    'duration': metadata.get('duration', 0),
+                    'platform': metadata.get('platform', ''),
+                    'format': metadata.get('format', ''),
+                    'thumbnail': metadata.get('thumbnail', ''),
                 })
 
     # Sort by modified date, newest first
@@ -326,6 +898,7 @@ def api_delete():
 
     if os.path.exists(filepath):
         os.remove(filepath)
+        library.forget(filename)
         return jsonify({'success': True, 'message': 'File deleted'})
     else:
         return jsonify({'success': False, 'error': 'File not found'})
@@ -337,6 +910,12 @@ def serve_download(filename):
     return send_from_directory(DOWNLOAD_DIR, filename, as_attachment=True)
 
 
+@app.route('/thumbs/<name>')
+def serve_thumbnail(name):
+    """Serve cached thumbnails"""
+    return send_from_directory(library.thumb_dir, name, max_age=THUMBNAIL_MAX_AGE)
+
+
 if __name__ == '__main__':
     print(f"Zingy Web App")
     print(f"Download directory: {DOWNLOAD_DIR}")
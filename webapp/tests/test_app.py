@@ -0,0 +1,284 @@
+"""
+Tests for format ranking and resolution in the web app
+"""
+
+import email.message
+import io
+import os
+import sys
+import tempfile
+
+# Keep DOWNLOAD_DIR and the thumbnail cache out of the real home directory
+os.environ['HOME'] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import yt_dlp
+
+import app
+
+URL = 'https://www.youtube.com/watch?v=abcdefghijk'
+
+
+def make_info():
+    def fmt(format_id, ext, height=None, vcodec='none', acodec='none', tbr=0):
+        return {
+            'format_id': format_id,
+            'ext': ext,
+            'height': height,
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'tbr': tbr,
+            'url': f'https://example.com/{format_id}',
+            'protocol': 'https',
+        }
+
+    return {
+        'id': 'abcdefghijk',
+        'title': 'Test Video',
+        'duration': 60,
+        'extractor': 'youtube',
+        'extractor_key': 'Youtube',
+        'webpage_url': URL,
+        'formats': [
+            fmt('140', 'm4a', acodec='mp4a.40.2', tbr=128),
+            fmt('251', 'webm', acodec='opus', tbr=160),
+            fmt('18', 'mp4', 360, 'avc1.42001E', 'mp4a.40.2', 500),
+            fmt('22', 'mp4', 720, 'avc1.64001F', 'mp4a.40.2', 2000),
+            fmt('137', 'mp4', 1080, 'avc1.640028', tbr=4000),
+        ],
+    }
+
+
+def probe(info):
+    """Run yt-dlp's default merged selection, as the /api/formats probe would"""
+    with yt_dlp.YoutubeDL({'quiet': True, 'format': 'bestvideo*+bestaudio/best'}) as ydl:
+        return ydl.process_ie_result(info, download=False)
+
+
+@pytest.fixture
+def captured(monkeypatch):
+    """Record what reaches process_info instead of downloading"""
+    calls = []
+
+    def fake_process_info(self, info_dict):
+        calls.append({
+            'format_id': info_dict.get('format_id'),
+            'requested': [f['format_id'] for f in info_dict.get('requested_formats') or []],
+        })
+        path = self.prepare_filename(info_dict)
+        with open(path, 'w') as f:
+            f.write('x')
+        info_dict['filepath'] = path
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', fake_process_info)
+    return calls
+
+
+def run_download(format_id, policy=None):
+    download_id = f'test-{format_id}'
+    progress = app.DownloadProgress(download_id)
+    app.downloads[download_id] = progress
+    app.download_video_task(download_id, URL, format_id, policy)
+    return progress
+
+
+def test_single_file_choice_ignores_probe_selection(captured):
+    probed = probe(make_info())
+    assert probed['requested_formats'][0]['format_id'] == '137'
+    app.cache_formats(URL, probed)
+
+    progress = run_download('18')
+
+    assert progress.status == 'completed', progress.error
+    assert captured == [{'format_id': '18', 'requested': []}]
+    # The cached probe must not be modified by the download
+    assert 'requested_downloads' not in app.get_cached_formats(URL)[0]
+
+
+def test_policy_without_merge_picks_progressive(captured):
+    app.cache_formats(URL, probe(make_info()))
+
+    progress = run_download('policy:best_720p_no_merge')
+
+    assert progress.status == 'completed', progress.error
+    assert captured[0]['format_id'] == '22'
+
+
+def test_missing_output_is_an_error(monkeypatch):
+    monkeypatch.setattr(yt_dlp.YoutubeDL, 'process_info', lambda self, info_dict: None)
+    app.cache_formats(URL, probe(make_info()))
+
+    progress = run_download('22')
+
+    assert progress.status == 'error'
+    assert 'without writing a file' in progress.error
+
+
+@pytest.mark.parametrize('format_spec, expected', [
+    ('18', 500 * 125 * 60),
+    ('bestaudio[ext=m4a]', 128 * 125 * 60),
+    ('137+140', (4000 + 128) * 125 * 60),
+])
+def test_download_size_estimated_from_selection(format_spec, expected):
+    assert app.estimate_download_size(probe(make_info()), format_spec) == expected
+
+
+def test_merge_pairs_compatible_audio():
+    table = app.rank_formats(make_info())
+    merged = [e for e in table if e['needs_merge']]
+    assert [e['id'] for e in merged] == ['137+140']
+
+
+@pytest.mark.parametrize('duration', [60, 3600, 2 * 3600])
+def test_long_videos_still_prefer_higher_resolution(duration):
+    info = make_info()
+    info['duration'] = duration
+    table = app.rank_formats(info, merge=False)
+
+    assert app.select_format(table, {})['id'] == '22'
+    assert app.select_format(table, app.FORMAT_POLICIES['best_720p_no_merge'])['id'] == '22'
+    # Audio-only entries never outrank video in the dropdown
+    assert [e['has_video'] for e in table] == sorted((e['has_video'] for e in table), reverse=True)
+
+
+def test_bloated_bitrate_loses_to_efficient_format_at_same_height():
+    info = make_info()
+    info['formats'].append({'format_id': '22b', 'ext': 'webm', 'height': 720, 'vcodec': 'vp9',
+                            'acodec': 'opus', 'tbr': 12000, 'url': 'https://example.com/22b',
+                            'protocol': 'https'})
+    table = app.rank_formats(info, merge=False)
+    assert app.select_format(table, {})['id'] == '22'
+
+
+def test_formatless_info_keeps_its_media_url():
+    with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        probed = ydl.process_ie_result({
+            'id': 'v', 'title': 'Direct', 'duration': 10, 'tbr': 800,
+            'url': 'https://example.com/v.mp4', 'ext': 'mp4',
+            'extractor': 'generic', 'extractor_key': 'Generic', 'webpage_url': 'https://example.com/v',
+        }, download=False)
+
+    assert app.fresh_info(probed)['url'] == 'https://example.com/v.mp4'
+    assert app.estimate_download_size(probed, 'best') == 800 * 125 * 10
+
+
+def test_merge_skipped_without_ffmpeg():
+    table = app.rank_formats(make_info(), merge=False)
+    assert not any(e['needs_merge'] for e in table)
+
+
+@pytest.mark.parametrize('policy', [
+    {'max_height': '720'},
+    {'allow_merge': 1},
+    {'max_height': True},
+    {'prefer': 'largest'},
+    {'unknown': 1},
+    ['max_height', 720],
+])
+def test_invalid_policy_rejected(policy):
+    client = app.app.test_client()
+    resp = client.post('/api/download', json={'url': URL, 'policy': policy})
+    assert resp.status_code == 400
+    assert 'Invalid policy' in resp.get_json()['error']
+
+
+def test_valid_policy_accepted():
+    assert app.validate_policy({'max_height': 720, 'max_size_mb': 49.5, 'allow_merge': False}) is None
+
+
+def test_format_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(app, 'format_cache', {})
+    for i in range(app.FORMAT_CACHE_MAX + 5):
+        app.cache_formats(f'{URL}&i={i}', make_info())
+    assert len(app.format_cache) == app.FORMAT_CACHE_MAX
+    assert f'{URL}&i=0' not in app.format_cache
+
+
+class FakeResponse(io.BytesIO):
+    def __init__(self, data, content_type):
+        super().__init__(data)
+        self.headers = email.message.Message()
+        self.headers['Content-Type'] = content_type
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    responses = {}
+    monkeypatch.setattr(app.urllib.request, 'urlopen', lambda req, timeout: responses[req.full_url])
+    monkeypatch.setattr(app, 'Image', None)
+    lib = app.MediaLibrary(str(tmp_path))
+    lib.responses = responses
+    return lib
+
+
+def test_thumbnail_extension_follows_content_type(library):
+    library.responses['https://cdn/a'] = FakeResponse(b'RIFF....WEBP', 'image/webp')
+    library._fetch('https://cdn/a')
+    assert library.thumbnail_path('https://cdn/a').endswith('.webp')
+
+
+def test_oversized_thumbnail_rejected(library):
+    library.responses['https://cdn/big'] = FakeResponse(b'x' * (app.THUMBNAIL_MAX_BYTES + 1), 'image/jpeg')
+    with pytest.raises(ValueError):
+        library._fetch('https://cdn/big')
+    assert library.thumbnail_path('https://cdn/big') == ''
+
+
+def test_forget_collects_unreferenced_thumbnails(library):
+    for url, data in [('https://cdn/kept', b'kept'), ('https://cdn/gone', b'gone'), ('https://cdn/probe', b'probe')]:
+        library.responses[url] = FakeResponse(data, 'image/jpeg')
+        library._fetch(url)
+    library.index['files']['kept.mp4'] = {'thumbnail_url': 'https://cdn/kept'}
+    library.index['files']['gone.mp4'] = {'thumbnail_url': 'https://cdn/gone'}
+
+    library.forget('gone.mp4')
+
+    assert list(library.index['thumbnails']) == ['https://cdn/kept']
+    assert os.listdir(library.thumb_dir) == [library.index['thumbnails']['https://cdn/kept']]
+
+
+@pytest.fixture
+def quota(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DOWNLOAD_QUOTA_BYTES', 100)
+    monkeypatch.setattr(app, 'MIN_FREE_BYTES', 0)
+    return app.StorageAdmission(str(tmp_path))
+
+
+def test_quota_does_not_double_count_in_flight_files(quota, tmp_path):
+    assert quota.admit('a', 50) is None
+    part = tmp_path / 'video.mp4.part'
+    part.write_bytes(b'x' * 50)
+    quota.track_file('a', str(part))
+
+    # 50 reserved for 'a' (already fully written) + 50 for 'b' fits a 100 byte quota
+    fits_now, fits_ever, fits_quota = quota._check(quota._device(), 50)
+    assert fits_now and fits_ever and fits_quota
+
+
+def test_quota_counts_finished_files(quota, tmp_path):
+    (tmp_path / 'done.mp4').write_bytes(b'x' * 60)
+    assert quota.admit('a', 30) is None
+
+    fits_now, _, fits_quota = quota._check(quota._device(), 20)
+    assert not fits_now and fits_quota
+
+
+def test_job_larger_than_quota_rejected(quota):
+    error = quota.admit('a', 101)
+    assert error.startswith('Download quota exceeded')
+    assert 'a' not in quota.reservations
+
+
+@pytest.mark.parametrize('url', ['file:///etc/passwd', 'ftp://host/a.jpg', 'data:image/png;base64,AAAA'])
+def test_non_http_thumbnails_never_fetched(library, url):
+    library.prefetch(url)
+    assert library.queue.empty()
+    with pytest.raises(ValueError):
+        library._fetch(url)